@@ -1,12 +1,16 @@
-import base64
+import csv
+import hashlib
+import io
+import json
 import os
-import random
-import string
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import httpx
 import streamlit as st
-from openai import OpenAI
-
-from captcha.image import ImageCaptcha
+from openai import DefaultHttpxClient, OpenAI
 
 
 # -----------------------
@@ -19,6 +23,9 @@ st.caption("Evalúa coherencia entre el nivel Bloom declarado y la actividad (te
 # -----------------------
 # OpenAI key (Streamlit Secrets primero)
 # -----------------------
+# st.cache_resource y no functools.lru_cache: Streamlit re-ejecuta el script en cada
+# rerun y redefine la función, así que un lru_cache se perdería en cada interacción
+@st.cache_resource
 def get_api_key() -> str | None:
     if "OPENAI_API_KEY" in st.secrets:
         return st.secrets["OPENAI_API_KEY"]
@@ -26,6 +33,8 @@ def get_api_key() -> str | None:
 
 api_key = get_api_key()
 if not api_key:
+    # No se deja cacheada una clave ausente: al corregir los secrets, el siguiente rerun la lee
+    get_api_key.clear()
     st.error(
         "Falta configurar OPENAI_API_KEY.\n\n"
         "En Streamlit Cloud: Settings → Secrets → agrega:\n"
@@ -33,12 +42,26 @@ if not api_key:
     )
     st.stop()
 
-client = OpenAI(api_key=api_key)
+@st.cache_resource
+def get_client() -> OpenAI:
+    # Un solo cliente por proceso: reutiliza el pool de conexiones HTTP entre reruns.
+    # HTTP/2 multiplexa evaluación, seguimiento y precálculos sobre la misma conexión.
+    # DefaultHttpxClient conserva los valores del SDK (timeouts largos, redirects).
+    http_client = DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    )
+    return OpenAI(api_key=get_api_key(), http_client=http_client)
+
+client = get_client()
 
 # -----------------------
-# ReflexIA v3 (Bloom)
+# Prompts (se construyen una vez por proceso, no en cada rerun)
 # -----------------------
-REFLEXIA_V3 = r"""
+@st.cache_resource
+def get_prompts() -> dict[str, str]:
+    # ReflexIA v3 (Bloom)
+    v3 = r"""
 Rol
 Eres ReflexIA, revisor crítico pedagógico.
 Tu tarea es evaluar actividades formativas contrastándolas únicamente con el nivel cognitivo declarado en el objetivo de aprendizaje.
@@ -85,10 +108,8 @@ Estilo
 Directo, preciso, sin ambigüedades, sin textos largos.
 """
 
-# -----------------------
-# Prompt de seguimiento (decisión del docente)
-# -----------------------
-REFLEXIA_FOLLOWUP = r"""
+    # Prompt de seguimiento (decisión del docente)
+    followup = r"""
 Eres ReflexIA. Vas a proponer un siguiente paso a partir de:
 - Nivel Bloom declarado por el docente (NO lo cambies salvo que el docente lo pida explícitamente).
 - Objetivo (texto) del docente
@@ -101,38 +122,399 @@ Reglas:
 - Si el docente pide subir/bajar nivel, entonces sí: propone cómo reestructurar la misma actividad para ese nuevo nivel.
 """
 
+    # Evaluación + siguiente paso en una sola llamada
+    combinado = (
+        v3
+        + r"""
+Segunda parte (siguiente paso)
+Después de evaluar, usa tu propia evaluación como "Resultado previo" y aplica estas reglas:
+"""
+        + followup
+        + r"""
+Salida
+Responde solo con el JSON pedido:
+- "evaluacion": la evaluación completa en el formato de salida indicado arriba.
+- "siguiente_paso": el siguiente paso según la decisión del docente (si no es evaluable, indica qué insumo falta).
+"""
+    )
+
+    return {"v3": v3, "followup": followup, "combinado": combinado}
+
+PROMPTS = get_prompts()
+REFLEXIA_V3 = PROMPTS["v3"]
+REFLEXIA_FOLLOWUP = PROMPTS["followup"]
+REFLEXIA_COMBINADO = PROMPTS["combinado"]
+
+NIVELES_BLOOM = ["Recordar", "Comprender", "Aplicar", "Analizar", "Evaluar", "Crear"]
+
+DECISIONES = [
+    "Elegir 2 mejoras concretas manteniendo el nivel",
+    "Pedir 3 alternativas lúdicas manteniendo el nivel",
+    "Crear una rúbrica breve (3 criterios)",
+    "Redactar retroalimentación automática (1–2 líneas)",
+    "Subir el nivel (decisión del docente)",
+    "Bajar el nivel (decisión del docente)",
+]
+
+# Salida estructurada de la llamada combinada (evaluación + siguiente paso)
+REFLEXIA_COMBINADO_SCHEMA = {
+    "type": "json_schema",
+    "name": "reflexia_evaluacion_y_siguiente_paso",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "evaluacion": {"type": "string"},
+            "siguiente_paso": {"type": "string"},
+        },
+        "required": ["evaluacion", "siguiente_paso"],
+        "additionalProperties": False,
+    },
+}
+
+# Claves estables de caché de prompt (el prefijo de instrucciones es idéntico entre usuarios).
+# Hoy los prompts (~570, ~140 y ~820 tokens) no llegan al mínimo de 1024 tokens del caché
+# de OpenAI, así que no hay aciertos: las claves solo sirven si los prompts crecen.
+# No se rellenan para cruzar el umbral: se pagarían más tokens de entrada en cada llamada.
+CACHE_KEY_EVALUACION = "reflexia_v3_es"
+CACHE_KEY_FOLLOWUP = "reflexia_followup_es"
+CACHE_KEY_COMBINADO = "reflexia_combinado_es"
+
+# Memo de resultados para entradas idénticas (evita repetir la llamada a la API)
+RESULT_CACHE_TTL = 3600
+RESULT_CACHE_MAX_ENTRIES = 256
+
+# Presupuesto de tokens de entrada: por encima se avisa sin llamar a la API
+MAX_INPUT_TOKENS = 12_000
+# Si el encoder de tiktoken no carga, se omite el chequeo durante este tiempo antes de reintentar
+ENCODER_RETRY_AFTER = 600
+
+# Las imágenes subidas a OpenAI Files caducan solas; el file_id cacheado vive menos que el archivo
+IMAGE_FILE_EXPIRES = 2 * RESULT_CACHE_TTL
+
+# Lado máximo de la imagen enviada al modelo (3x3 tiles de 512 px en modo "high")
+IMAGE_MAX_SIDE = 1536
+
+# Decisiones más frecuentes que se precalculan mientras el docente lee el resultado
+PREFETCH_DECISIONES = DECISIONES[:2]
+# Con más precálculos pendientes en el proceso, no se encolan nuevos (llegarían tarde)
+PREFETCH_MAX_PENDING = 4
+
 # -----------------------
 # Helpers OpenAI
 # -----------------------
-def to_data_url(uploaded_file) -> str:
-    raw = uploaded_file.getvalue()
-    b64 = base64.b64encode(raw).decode("utf-8")
-    mime = uploaded_file.type or "image/png"
-    return f"data:{mime};base64,{b64}"
+def image_key(uploaded_file) -> str:
+    # UploadedFile no es hasheable: se usa el hash de sus bytes como clave de caché
+    return hashlib.blake2b(uploaded_file.getvalue()).hexdigest()
+
+def downscale_image(raw: bytes, mime: str) -> tuple[bytes, str]:
+    """
+    Reduce la imagen a IMAGE_MAX_SIDE (JPEG q85) antes de enviarla al modelo.
+    Si ya es suficientemente pequeña y no viene rotada (EXIF), se envía tal cual.
+    """
+    from PIL import Image, ImageOps
+
+    im = Image.open(io.BytesIO(raw))
+    rotada = im.getexif().get(0x0112, 1) != 1  # Orientation
+    if max(im.size) <= IMAGE_MAX_SIDE and not rotada:
+        return raw, mime
+
+    # Fotos de celular: aplica la orientación EXIF, que se perdería al re-codificar
+    im = ImageOps.exif_transpose(im)
+    im.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+
+    # JPEG no tiene transparencia: se compone sobre blanco en vez de dejarla negra
+    if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        fondo = Image.new("RGB", im.size, "white")
+        fondo.paste(im, mask=im.getchannel("A"))
+        im = fondo
+
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, format="JPEG", quality=85)
+    return buf.getvalue(), "image/jpeg"
+
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, show_spinner=False)
+def upload_image(imagen_key: str, _uploaded_file) -> str:
+    """
+    Reduce y sube la imagen una sola vez a OpenAI Files y retorna su file_id.
+    Evita codificarla en base64 dentro de cada petición. Solo se cachea el file_id
+    (no los bytes). El archivo caduca tras IMAGE_FILE_EXPIRES segundos para no
+    acumular imágenes de docentes.
+    """
+    raw, mime = downscale_image(_uploaded_file.getvalue(), _uploaded_file.type or "image/png")
+    uploaded = client.files.create(
+        file=(f"img.{mime.split('/')[-1]}", raw),
+        purpose="vision",
+        expires_after={"anchor": "created_at", "seconds": IMAGE_FILE_EXPIRES},
+    )
+    return uploaded.id
+
+def image_file_id(uploaded_file) -> str:
+    return upload_image(image_key(uploaded_file), uploaded_file)
+
+@st.cache_resource
+def _results_cache() -> tuple[OrderedDict, threading.Lock]:
+    """
+    Memo compartido por el proceso: clave -> (timestamp, texto).
+    st.cache_data no puede cachear generadores, por eso el streaming usa este memo.
+    """
+    return OrderedDict(), threading.Lock()
+
+def _memo_get(memo, key: tuple) -> str | None:
+    cache, lock = memo
+    with lock:
+        hit = cache.get(key)
+    if hit and time.time() - hit[0] < RESULT_CACHE_TTL:
+        return hit[1]
+    return None
+
+def _memo_put(memo, key: tuple, text: str):
+    # No se guardan respuestas vacías
+    if not text.strip():
+        return
+    cache, lock = memo
+    with lock:
+        cache[key] = (time.time(), text)
+        cache.move_to_end(key)
+        while len(cache) > RESULT_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def _memo_stream(key: tuple, make_stream):
+    """
+    Si la clave ya tiene resultado vigente, lo entrega de una vez; si no, hace
+    streaming normal y guarda el texto completo al terminar. Solo se guardan
+    respuestas completas (el stream lanza si no llega response.completed) y no vacías.
+    """
+    memo = _results_cache()
+    hit = _memo_get(memo, key)
+    if hit is not None:
+        yield hit
+        return
+
+    parts = []
+    for chunk in make_stream():
+        parts.append(chunk)
+        yield chunk
+
+    _memo_put(memo, key, "".join(parts))
+
+def _stream_output_text(**kwargs):
+    """
+    Llama a la Responses API en modo streaming y va entregando los fragmentos de texto.
+    Lanza RuntimeError si el stream no termina con response.completed.
+    """
+    completed = False
+    # with: cierra la respuesta HTTP aunque se corte la iteración (error o rerun de Streamlit)
+    with client.responses.create(stream=True, **kwargs) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed":
+                completed = True
+            elif event.type == "error":
+                raise RuntimeError(event.message)
+            elif event.type == "response.failed":
+                error = event.response.error
+                raise RuntimeError(error.message if error else "la respuesta falló")
+            elif event.type == "response.incomplete":
+                details = event.response.incomplete_details
+                raise RuntimeError(f"respuesta incompleta ({details.reason if details else 'sin detalle'})")
+    if not completed:
+        raise RuntimeError("el stream terminó sin completar la respuesta")
+
+def run_reflexia_text_stream(model: str, objetivo: str, actividad: str):
+    yield from _memo_stream(
+        ("texto", model, objetivo, actividad),
+        lambda: _stream_output_text(
+            model=model,
+            instructions=REFLEXIA_V3,
+            prompt_cache_key=CACHE_KEY_EVALUACION,
+            input=f"{objetivo}\n\nActividad (texto):\n{actividad}",
+        ),
+    )
+
+def run_reflexia_image_stream(model: str, objetivo: str, imagen):
+    yield from _memo_stream(
+        ("imagen", model, objetivo, image_key(imagen)),
+        lambda: _stream_output_text(
+            model=model,
+            instructions=REFLEXIA_V3,
+            prompt_cache_key=CACHE_KEY_EVALUACION,
+            input=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": f"{objetivo}\n\nActividad: (imagen adjunta)"},
+                        {"type": "input_image", "file_id": image_file_id(imagen)},
+                    ],
+                }
+            ],
+        ),
+    )
+
+def run_followup_stream(model: str, follow_input: str):
+    yield from _memo_stream(
+        ("followup", model, follow_input),
+        lambda: _stream_output_text(
+            model=model,
+            instructions=REFLEXIA_FOLLOWUP,
+            prompt_cache_key=CACHE_KEY_FOLLOWUP,
+            input=follow_input,
+        ),
+    )
+
+@st.cache_data(ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, show_spinner=False)
+def run_reflexia_combined(
+    model: str,
+    objetivo: str,
+    decision: str,
+    nuevo_nivel: str | None = None,
+    actividad: str | None = None,
+    imagen_key: str | None = None,
+    _imagen=None,
+) -> dict:
+    """
+    Evalúa la actividad y propone el siguiente paso en una sola llamada.
+    Retorna {"evaluacion": ..., "siguiente_paso": ...}.
+    La imagen se identifica en la caché por `imagen_key` (hash de sus bytes).
+    """
+    texto = f"{objetivo}\n\nDecisión del docente:\n{decision}\n"
+    if nuevo_nivel:
+        texto += f"\nNuevo nivel Bloom decidido por el docente: {nuevo_nivel}\n"
+
+    if _imagen is not None:
+        content = [
+            {"type": "input_text", "text": f"{texto}\nActividad: (imagen adjunta)"},
+            {"type": "input_image", "file_id": image_file_id(_imagen)},
+        ]
+    else:
+        content = [{"type": "input_text", "text": f"{texto}\nActividad (texto):\n{actividad}"}]
 
-def run_reflexia_text(model: str, objetivo: str, actividad: str) -> str:
     resp = client.responses.create(
         model=model,
-        instructions=REFLEXIA_V3,
-        input=f"{objetivo}\n\nActividad (texto):\n{actividad}",
+        instructions=REFLEXIA_COMBINADO,
+        prompt_cache_key=CACHE_KEY_COMBINADO,
+        input=[{"role": "user", "content": content}],
+        text={"format": REFLEXIA_COMBINADO_SCHEMA},
     )
-    return resp.output_text
+    return json.loads(resp.output_text)
+
+def build_follow_input(
+    bloom: str, objetivo_texto: str, resultado: str, decision: str, nuevo_nivel: str | None = None
+) -> str:
+    follow_input = f"""
+Nivel Bloom declarado por el docente: {bloom}
+
+Objetivo de aprendizaje (texto):
+{objetivo_texto}
+
+Resultado previo de ReflexIA:
+{resultado}
 
-def run_reflexia_image(model: str, objetivo: str, image_data_url: str) -> str:
+Decisión del docente:
+{decision}
+"""
+    if nuevo_nivel:
+        follow_input += f"\nNuevo nivel Bloom decidido por el docente: {nuevo_nivel}\n"
+    return follow_input
+
+@st.cache_resource
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    # Máximo 2 hilos por proceso: las instancias de Streamlit Cloud tienen poca memoria
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="reflexia-prefetch")
+
+@st.cache_resource
+def _prefetch_pending() -> tuple[set, threading.Lock]:
+    # Futures del pool aún no terminados (de todas las sesiones), para acotar la cola
+    return set(), threading.Lock()
+
+def _prefetch_followup(memo, model: str, follow_input: str):
+    # Corre en un hilo del pool: recibe el memo ya resuelto (sin llamadas a st.*)
     resp = client.responses.create(
         model=model,
-        instructions=REFLEXIA_V3,
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": f"{objetivo}\n\nActividad: (imagen adjunta)"},
-                    {"type": "input_image", "image_url": image_data_url},
-                ],
-            }
-        ],
+        instructions=REFLEXIA_FOLLOWUP,
+        prompt_cache_key=CACHE_KEY_FOLLOWUP,
+        input=follow_input,
     )
-    return resp.output_text
+    if resp.status == "completed":
+        _memo_put(memo, ("followup", model, follow_input), resp.output_text)
+
+def prefetch_followups(model: str, bloom: str, objetivo_texto: str, resultado: str):
+    """
+    Lanza en segundo plano el siguiente paso de las decisiones más frecuentes.
+    El resultado queda en el mismo memo que usa run_followup_stream; las decisiones
+    que ya están en el memo no se vuelven a pedir. Los futures quedan en session_state.
+    """
+    # Los precálculos de una evaluación anterior ya no sirven: se cancelan si siguen en cola
+    for future in st.session_state.get("prefetched_followups", {}).values():
+        future.cancel()
+    st.session_state["prefetched_followups"] = {}
+
+    executor = get_prefetch_executor()
+    memo = _results_cache()
+    pending, lock = _prefetch_pending()
+    for decision in PREFETCH_DECISIONES:
+        follow_input = build_follow_input(bloom, objetivo_texto, resultado, decision)
+        if _memo_get(memo, ("followup", model, follow_input)) is not None:
+            continue
+        with lock:
+            if len(pending) >= PREFETCH_MAX_PENDING:
+                return
+            future = executor.submit(_prefetch_followup, memo, model, follow_input)
+            pending.add(future)
+
+        def _done(f, pending=pending, lock=lock):
+            with lock:
+                pending.discard(f)
+
+        future.add_done_callback(_done)
+        st.session_state["prefetched_followups"][follow_input] = future
+
+@st.cache_resource
+def get_encoder(model: str):
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+@st.cache_resource
+def _encoder_failures() -> dict[str, float]:
+    # st.cache_resource no cachea excepciones: se recuerda aquí cuándo falló la carga por modelo
+    return {}
+
+def count_tokens(model: str, text: str) -> int | None:
+    """
+    Cuenta tokens localmente. Retorna None si el encoder no se puede cargar
+    (p. ej. tiktoken sin red para descargar su tabla BPE): el chequeo se omite.
+    Tras un fallo no se reintenta la descarga durante ENCODER_RETRY_AFTER segundos.
+    """
+    failures = _encoder_failures()
+    if time.time() - failures.get(model, 0.0) < ENCODER_RETRY_AFTER:
+        return None
+    try:
+        return len(get_encoder(model).encode(text))
+    except Exception:
+        failures[model] = time.time()
+        return None
+
+def check_token_budget(model: str, instructions: str, *parts: str):
+    """
+    Cuenta los tokens localmente y detiene la ejecución si la entrada excede MAX_INPUT_TOKENS.
+    """
+    n_tokens = count_tokens(model, instructions + "".join(parts))
+    if n_tokens is not None and n_tokens > MAX_INPUT_TOKENS:
+        st.warning(
+            f"La entrada es demasiado larga ({n_tokens} tokens; máximo {MAX_INPUT_TOKENS}). "
+            "Acorta el objetivo o la actividad."
+        )
+        st.stop()
+
+def show_combined(data: dict) -> str:
+    st.subheader("Resultado")
+    st.code(data["evaluacion"], language="text")
+    st.subheader("Siguiente paso sugerido")
+    st.code(data["siguiente_paso"], language="text")
+    return data["evaluacion"]
 
 if "pending_eval" not in st.session_state:
     st.session_state["pending_eval"] = False
@@ -144,8 +526,12 @@ if "pending_payload" not in st.session_state:
 # CAPTCHA (anti-bots) — 100% Python, funciona en Streamlit Cloud
 # -----------------------
 def _new_captcha_text(n: int = 5) -> str:
+    # secrets (CSPRNG) en vez de random: un CAPTCHA no debe ser predecible
+    import secrets
+    import string
+
     alphabet = string.ascii_uppercase + string.digits
-    return "".join(random.choice(alphabet) for _ in range(n))
+    return "".join(secrets.choice(alphabet) for _ in range(n))
 
 def ensure_captcha():
     if "captcha_text" not in st.session_state:
@@ -158,19 +544,27 @@ def refresh_captcha():
     st.session_state["captcha_ok"] = False
     st.session_state["captcha_input"] = ""
 
+# Cada texto es aleatorio y casi nunca se repite entre usuarios: caché pequeña y de vida corta
+@st.cache_data(ttl=600, max_entries=64, show_spinner=False)
+def _render_captcha_png(text: str) -> bytes:
+    # Import diferido: captcha (y Pillow) solo se cargan cuando hace falta mostrar un CAPTCHA
+    from captcha.image import ImageCaptcha
+
+    return ImageCaptcha(width=220, height=80).generate(text).read()
+
 def captcha_block() -> bool:
     """
     Retorna True si está verificado. Si no, muestra UI y retorna False.
     """
-    ensure_captcha()
+    # Ya verificado: no se vuelve a renderizar la imagen ni los controles
     if st.session_state.get("captcha_ok"):
         return True
-    
+
+    ensure_captcha()
     st.markdown("### Anti-bots (CAPTCHA)")
     st.caption("Escribe el código de la imagen para poder evaluar. (Puedes regenerarlo).")
 
-    img = ImageCaptcha(width=220, height=80)
-    png_bytes = img.generate(st.session_state["captcha_text"]).read()
+    png_bytes = _render_captcha_png(st.session_state["captcha_text"])
 
     c1, c2 = st.columns([1, 1])
     with c1:
@@ -188,12 +582,258 @@ def captcha_block() -> bool:
 
     return bool(st.session_state.get("captcha_ok"))
 
+# -----------------------
+# Modo lote (OpenAI Batch API) — evaluación diferida de muchas actividades
+# -----------------------
+BATCH_COLUMNS = ["bloom", "objetivo", "actividad"]
+# La app es pública y usa la clave del dueño: tope de filas por lote
+MAX_BATCH_ROWS = 200
+# Marca de los lotes creados por esta app; solo esos se pueden recuperar por id
+BATCH_METADATA = {"app": "reflexia"}
+
+def read_batch_csv(uploaded_file) -> list[dict]:
+    """
+    Lee el CSV (columnas bloom, objetivo, actividad, máximo MAX_BATCH_ROWS filas)
+    y valida cada fila. Lanza ValueError con un mensaje para el docente si algo no es válido.
+    """
+    try:
+        text = uploaded_file.getvalue().decode("utf-8-sig")
+        reader = csv.DictReader(io.StringIO(text))
+        fieldnames = reader.fieldnames or []
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise ValueError(f"El CSV no es válido: {e}") from e
+    faltantes = [c for c in BATCH_COLUMNS if c not in fieldnames]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en el CSV: {', '.join(faltantes)}")
+
+    rows = []
+    try:
+        for i, row in enumerate(reader, start=1):
+            if i > MAX_BATCH_ROWS:
+                raise ValueError(f"El CSV supera el máximo de {MAX_BATCH_ROWS} filas por lote.")
+            fila = {c: (row.get(c) or "").strip() for c in BATCH_COLUMNS}
+            if not all(fila.values()):
+                raise ValueError(f"Fila {i}: bloom, objetivo y actividad son obligatorios.")
+            if fila["bloom"] not in NIVELES_BLOOM:
+                raise ValueError(f"Fila {i}: nivel Bloom no válido ({fila['bloom']}).")
+            rows.append(fila)
+    except csv.Error as e:
+        raise ValueError(f"El CSV no es válido: {e}") from e
+    if not rows:
+        raise ValueError("El CSV no tiene filas.")
+    return rows
+
+def _batch_input(fila: dict) -> str:
+    objetivo = (
+        f"Nivel Bloom declarado por el docente: {fila['bloom']}\n"
+        f"Objetivo de aprendizaje (texto): {fila['objetivo']}"
+    )
+    return f"{objetivo}\n\nActividad (texto):\n{fila['actividad']}"
+
+def rows_over_budget(model: str, rows: list[dict]) -> list[int]:
+    """
+    Números de fila (desde 1) cuya entrada excede MAX_INPUT_TOKENS.
+    """
+    largas = []
+    for i, fila in enumerate(rows, start=1):
+        n_tokens = count_tokens(model, REFLEXIA_V3 + _batch_input(fila))
+        if n_tokens is None:
+            return []  # encoder no disponible: se omite el chequeo para todo el lote
+        if n_tokens > MAX_INPUT_TOKENS:
+            largas.append(i)
+    return largas
+
+def submit_batch(model: str, rows: list[dict]) -> str:
+    """
+    Sube un JSONL con una petición /v1/responses por fila y crea el batch. Retorna el batch id.
+    """
+    lines = []
+    for i, fila in enumerate(rows):
+        lines.append(json.dumps({
+            "custom_id": f"fila-{i}",
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": {
+                "model": model,
+                "instructions": REFLEXIA_V3,
+                "prompt_cache_key": CACHE_KEY_EVALUACION,
+                "input": _batch_input(fila),
+            },
+        }, ensure_ascii=False))
+
+    batch_file = client.files.create(
+        file=("reflexia_lote.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+        metadata=BATCH_METADATA,
+    )
+    return batch.id
+
+def _batch_output_text(body: dict) -> str:
+    # Equivalente a resp.output_text para el JSON crudo devuelto por el batch
+    return "".join(
+        part.get("text", "")
+        for item in body.get("output", [])
+        if item.get("type") == "message"
+        for part in item.get("content", [])
+        if part.get("type") == "output_text"
+    )
+
+def fetch_batch_results(batch) -> dict[str, str]:
+    """
+    Descarga los resultados (y errores) de un batch terminado. Retorna custom_id -> texto.
+    """
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                error = item.get("error") or response.get("body", {}).get("error") or {}
+                results[item["custom_id"]] = f"Error: {error.get('message', 'sin detalle')}"
+            else:
+                results[item["custom_id"]] = _batch_output_text(response["body"])
+    return results
+
+def batch_table(rows: list[dict] | None, results: dict[str, str]) -> list[dict]:
+    if rows is None:
+        # Lote recuperado por id: no se conocen las filas originales del CSV
+        orden = sorted(results, key=lambda custom_id: int(custom_id.split("-")[-1]))
+        return [{"fila": int(c.split("-")[-1]) + 1, "resultado": results[c]} for c in orden]
+    return [{**fila, "resultado": results.get(f"fila-{i}", "")} for i, fila in enumerate(rows)]
+
+def results_to_csv(table: list[dict]) -> bytes:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=list(table[0]) if table else ["resultado"])
+    writer.writeheader()
+    writer.writerows(table)
+    return buf.getvalue().encode("utf-8-sig")
+
+def batch_block(model: str):
+    st.caption(
+        "Sube un CSV con columnas bloom, objetivo y actividad. "
+        "Las evaluaciones se procesan en diferido (hasta 24 h) a menor costo."
+    )
+
+    # CAPTCHA fuera de los botones: si estuviera dentro de "Enviar lote", el clic en
+    # "Verificar CAPTCHA" se perdería en el rerun
+    if not captcha_block():
+        return
+
+    archivo = st.file_uploader("Actividades (CSV)", type=["csv"])
+
+    # Un lote a la vez por sesión: evita reenvíos (doble clic) mientras el anterior no termina
+    lote_en_curso = bool(st.session_state.get("batch_id")) and "batch_results" not in st.session_state
+    if lote_en_curso:
+        st.info("Hay un lote en curso. Espera sus resultados antes de enviar otro.")
+
+    if st.button("Enviar lote", disabled=lote_en_curso):
+        if not archivo:
+            st.error("No subiste ningún CSV.")
+            st.stop()
+        try:
+            rows = read_batch_csv(archivo)
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+
+        largas = rows_over_budget(model, rows)
+        if largas:
+            st.warning(
+                f"Filas demasiado largas (máximo {MAX_INPUT_TOKENS} tokens): "
+                f"{', '.join(str(i) for i in largas)}. Acórtalas y vuelve a subir el CSV."
+            )
+            st.stop()
+
+        with st.spinner("Enviando lote…"):
+            try:
+                st.session_state["batch_id"] = submit_batch(model, rows)
+                st.session_state["batch_rows"] = rows
+                st.session_state.pop("batch_results", None)
+            except Exception as e:
+                st.error(f"Error al enviar el lote: {e}")
+                st.stop()
+
+    # El lote puede tardar hasta 24 h: se puede retomar con su id aunque se cierre la pestaña
+    with st.expander("Recuperar un lote enviado antes"):
+        batch_id = st.text_input("Id del lote", placeholder="batch_...")
+        if st.button("Recuperar lote"):
+            if not batch_id.strip():
+                st.error("Falta el id del lote.")
+                st.stop()
+            try:
+                batch = client.batches.retrieve(batch_id.strip())
+            except Exception as e:
+                st.error(f"Error al consultar el lote: {e}")
+                st.stop()
+            # Solo lotes creados por esta app: otros lotes de la cuenta no se muestran
+            if (batch.metadata or {}).get("app") != BATCH_METADATA["app"]:
+                st.error("Ese id no corresponde a un lote de ReflexIA.")
+                st.stop()
+            st.session_state["batch_id"] = batch.id
+            st.session_state["batch_rows"] = None
+            st.session_state.pop("batch_results", None)
+
+    if not st.session_state.get("batch_id"):
+        return
+
+    st.subheader("Estado del lote")
+    rows = st.session_state["batch_rows"]
+    st.caption("Guarda este id para recuperar el lote más tarde:")
+    st.code(st.session_state["batch_id"], language="text")
+    if rows is not None:
+        st.caption(f"{len(rows)} actividades")
+
+    if "batch_results" not in st.session_state and st.button("Actualizar estado"):
+        try:
+            batch = client.batches.retrieve(st.session_state["batch_id"])
+            if batch.status == "completed":
+                st.session_state["batch_results"] = fetch_batch_results(batch)
+            elif batch.status in ("failed", "expired", "cancelled"):
+                st.error(f"El lote terminó con estado: {batch.status}")
+                # Lote cerrado sin resultados: se permite enviar uno nuevo
+                st.session_state.pop("batch_id", None)
+            else:
+                counts = batch.request_counts
+                progreso = f" ({counts.completed}/{counts.total} completadas)" if counts else ""
+                st.info(f"Estado: {batch.status}{progreso}")
+        except Exception as e:
+            st.error(f"Error al consultar el lote: {e}")
+
+    if "batch_results" in st.session_state:
+        table = batch_table(rows, st.session_state["batch_results"])
+        st.dataframe(table, use_container_width=True)
+        st.download_button(
+            "Descargar resultados (CSV)",
+            data=results_to_csv(table),
+            file_name="reflexia_resultados.csv",
+            mime="text/csv",
+        )
+
+def footer():
+    st.divider()
+    st.caption("© jbc.elearning - 2026")
+
 st.divider()
 
 # -----------------------
 # Form
 # -----------------------
-modo = st.radio("Entrada de actividad", ["Texto", "Imagen"], horizontal=True)
+modo = st.radio("Entrada de actividad", ["Texto", "Imagen", "Lote (CSV)"], horizontal=True)
+
+if modo == "Lote (CSV)":
+    # Fijo, igual que en el modo interactivo
+    batch_block("gpt-4o-mini")
+    footer()
+    st.stop()
 
 with st.form("reflexia_form"):
     col1, col2 = st.columns([1, 1])
@@ -201,7 +841,7 @@ with st.form("reflexia_form"):
     with col1:
         bloom = st.selectbox(
             "Elige el nivel bloom (obligatorio) al que deseas llegar con tu actividad",
-            ["Recordar", "Comprender", "Aplicar", "Analizar", "Evaluar", "Crear"],
+            NIVELES_BLOOM,
             index=2,
         )
 
@@ -227,9 +867,34 @@ with st.form("reflexia_form"):
         imagen = st.file_uploader("Actividad (imagen)", type=["png", "jpg", "jpeg"])
         actividad_texto = None
 
-    submit = st.form_submit_button("Evaluar")
+    with st.expander("Evaluar y proponer siguiente paso (opcional)"):
+        st.caption("Elige tu decisión antes de evaluar para recibir evaluación y siguiente paso juntos.")
+        decision_previa = st.selectbox("¿Qué quieres hacer después de la evaluación?", DECISIONES, index=0)
+        nivel_previo = st.selectbox(
+            "Nuevo nivel Bloom (solo si decides subir o bajar el nivel):",
+            NIVELES_BLOOM,
+            index=NIVELES_BLOOM.index(bloom),
+        )
+
+    b1, b2 = st.columns([1, 1])
+    with b1:
+        submit = st.form_submit_button("Evaluar")
+    with b2:
+        submit_combinado = st.form_submit_button("Evaluar y proponer siguiente paso")
+
+if submit or submit_combinado:
+    if not submit_combinado:
+        decision_previa = None
+    if not decision_previa or not ("Subir el nivel" in decision_previa or "Bajar el nivel" in decision_previa):
+        nivel_previo = None
+    # Dentro del form el nivel por defecto no sigue al Bloom recién elegido: se valida la dirección
+    elif "Subir el nivel" in decision_previa and NIVELES_BLOOM.index(nivel_previo) <= NIVELES_BLOOM.index(bloom):
+        st.error(f"Para subir el nivel elige uno superior a {bloom}.")
+        st.stop()
+    elif "Bajar el nivel" in decision_previa and NIVELES_BLOOM.index(nivel_previo) >= NIVELES_BLOOM.index(bloom):
+        st.error(f"Para bajar el nivel elige uno inferior a {bloom}.")
+        st.stop()
 
-if submit:
     if not objetivo_texto.strip():
         st.error("Falta el objetivo (texto).")
         st.stop()
@@ -242,6 +907,8 @@ if submit:
         "objetivo_texto": objetivo_texto.strip(),
         "actividad_texto": (actividad_texto.strip() if actividad_texto else None),
         "imagen": imagen,  # UploadedFile (en este rerun existe)
+        "decision": decision_previa,  # None => solo evaluación
+        "nuevo_nivel": nivel_previo,
     }
     #refresh_captcha()  # CAPTCHA nuevo en cada evaluación
 
@@ -250,30 +917,54 @@ if submit:
 
     objetivo = f"Nivel Bloom declarado por el docente: {bloom}\nObjetivo de aprendizaje (texto): {objetivo_texto.strip()}"
 
+    check_token_budget(
+        model,
+        REFLEXIA_COMBINADO if decision_previa else REFLEXIA_V3,
+        objetivo,
+        actividad_texto or "",
+    )
+
     with st.spinner("Evaluando con ReflexIA…"):
         try:
             if modo == "Texto":
                 if not actividad_texto or not actividad_texto.strip():
                     st.error("Falta la actividad en texto.")
                     st.stop()
-                out = run_reflexia_text(model, objetivo, actividad_texto.strip())
+                if decision_previa:
+                    out = show_combined(
+                        run_reflexia_combined(
+                            model, objetivo, decision_previa, nivel_previo, actividad=actividad_texto.strip()
+                        )
+                    )
+                else:
+                    st.subheader("Resultado")
+                    out = st.write_stream(run_reflexia_text_stream(model, objetivo, actividad_texto.strip()))
             else:
                 if not imagen:
                     st.error("No subiste ninguna imagen.")
                     st.stop()
-                out = run_reflexia_image(model, objetivo, to_data_url(imagen))
-
-            st.subheader("Resultado")
-            st.code(out, language="text")
+                if decision_previa:
+                    out = show_combined(
+                        run_reflexia_combined(
+                            model, objetivo, decision_previa, nivel_previo,
+                            imagen_key=image_key(imagen), _imagen=imagen,
+                        )
+                    )
+                else:
+                    st.subheader("Resultado")
+                    out = st.write_stream(run_reflexia_image_stream(model, objetivo, imagen))
 
             # Guardar contexto para decisiones posteriores
             st.session_state["reflexia_ready"] = True
             st.session_state["reflexia_result"] = out
-            st.session_state["reflexia_objetivo"] = objetivo
+            st.session_state["reflexia_objetivo_tail"] = objetivo_texto.strip()
             st.session_state["reflexia_bloom"] = bloom
             st.session_state["reflexia_modo"] = modo
             st.session_state["reflexia_model"] = model
 
+            if not decision_previa:
+                prefetch_followups(model, bloom, objetivo_texto.strip(), out)
+
         except Exception as e:
             st.error(f"Error al llamar a la API: {e}")
             st.stop()
@@ -291,30 +982,59 @@ if st.session_state.get("pending_eval"):
                 f"Objetivo de aprendizaje (texto): {p['objetivo_texto']}"
             )
 
+            check_token_budget(
+                p["model"],
+                REFLEXIA_COMBINADO if p.get("decision") else REFLEXIA_V3,
+                objetivo,
+                p["actividad_texto"] or "",
+            )
+
             with st.spinner("Evaluando con ReflexIA…"):
                 try:
                     if p["modo"] == "Texto":
                         if not p["actividad_texto"]:
                             st.error("Falta la actividad en texto.")
                             st.stop()
-                        out = run_reflexia_text(p["model"], objetivo, p["actividad_texto"])
+                        if p.get("decision"):
+                            out = show_combined(
+                                run_reflexia_combined(
+                                    p["model"], objetivo, p["decision"], p["nuevo_nivel"],
+                                    actividad=p["actividad_texto"],
+                                )
+                            )
+                        else:
+                            st.subheader("Resultado")
+                            out = st.write_stream(
+                                run_reflexia_text_stream(p["model"], objetivo, p["actividad_texto"])
+                            )
                     else:
                         if not p["imagen"]:
                             st.error("No subiste ninguna imagen.")
                             st.stop()
-                        out = run_reflexia_image(p["model"], objetivo, to_data_url(p["imagen"]))
-
-                    st.subheader("Resultado")
-                    st.code(out, language="text")
+                        if p.get("decision"):
+                            out = show_combined(
+                                run_reflexia_combined(
+                                    p["model"], objetivo, p["decision"], p["nuevo_nivel"],
+                                    imagen_key=image_key(p["imagen"]), _imagen=p["imagen"],
+                                )
+                            )
+                        else:
+                            st.subheader("Resultado")
+                            out = st.write_stream(
+                                run_reflexia_image_stream(p["model"], objetivo, p["imagen"])
+                            )
 
                     # Guardar contexto para decisiones posteriores
                     st.session_state["reflexia_ready"] = True
                     st.session_state["reflexia_result"] = out
-                    st.session_state["reflexia_objetivo"] = objetivo
+                    st.session_state["reflexia_objetivo_tail"] = p["objetivo_texto"]
                     st.session_state["reflexia_bloom"] = p["bloom"]
                     st.session_state["reflexia_modo"] = p["modo"]
                     st.session_state["reflexia_model"] = p["model"]
 
+                    if not p.get("decision"):
+                        prefetch_followups(p["model"], p["bloom"], p["objetivo_texto"], out)
+
                     # Limpia el pendiente
                     st.session_state["pending_eval"] = False
                     st.session_state["pending_payload"] = {}
@@ -332,14 +1052,7 @@ if st.session_state.get("reflexia_ready"):
 
     decision = st.selectbox(
         "¿Qué quieres hacer ahora?",
-        [
-            "Elegir 2 mejoras concretas manteniendo el nivel",
-            "Pedir 3 alternativas lúdicas manteniendo el nivel",
-            "Crear una rúbrica breve (3 criterios)",
-            "Redactar retroalimentación automática (1–2 líneas)",
-            "Subir el nivel (decisión del docente)",
-            "Bajar el nivel (decisión del docente)",
-        ],
+        DECISIONES,
         index=0,
     )
 
@@ -347,42 +1060,41 @@ if st.session_state.get("reflexia_ready"):
     if "Subir el nivel" in decision or "Bajar el nivel" in decision:
         nuevo_nivel = st.selectbox(
             "Nuevo nivel Bloom (decisión del docente):",
-            ["Recordar", "Comprender", "Aplicar", "Analizar", "Evaluar", "Crear"],
-            index=["Recordar", "Comprender", "Aplicar", "Analizar", "Evaluar", "Crear"].index(
-                st.session_state["reflexia_bloom"]
-            ),
+            NIVELES_BLOOM,
+            index=NIVELES_BLOOM.index(st.session_state["reflexia_bloom"]),
         )
 
-    if st.button("Aplicar decisión"):
-        follow_input = f"""
-Nivel Bloom declarado por el docente: {st.session_state["reflexia_bloom"]}
-
-Objetivo de aprendizaje (texto):
-{st.session_state["reflexia_objetivo"].split('Objetivo de aprendizaje (texto):',1)[-1].strip()}
-
-Resultado previo de ReflexIA:
-{st.session_state["reflexia_result"]}
-
-Decisión del docente:
-{decision}
-"""
-        if nuevo_nivel:
-            follow_input += f"\nNuevo nivel Bloom decidido por el docente: {nuevo_nivel}\n"
+    # CAPTCHA antes del botón (no dentro de él): si faltara verificar, "Verificar CAPTCHA"
+    # debe seguir visible en el siguiente rerun
+    verificado = captcha_block()
+    clicked = st.button("Aplicar decisión", disabled=not verificado)
+    if clicked:
+        follow_input = build_follow_input(
+            st.session_state["reflexia_bloom"],
+            st.session_state["reflexia_objetivo_tail"],
+            st.session_state["reflexia_result"],
+            decision,
+            nuevo_nivel,
+        )
 
         with st.spinner("Generando siguiente paso…"):
+            # Los precálculos que no han empezado se cancelan: el pool es compartido y no se
+            # espera en su cola. Si el de esta decisión ya está en curso, se espera a que termine
+            # para no pagar dos veces; al terminar queda en el memo que lee run_followup_stream.
+            for prefetch_input, future in st.session_state.get("prefetched_followups", {}).items():
+                if not future.cancel() and prefetch_input == follow_input:
+                    try:
+                        future.result()
+                    except Exception:
+                        pass  # si el precálculo falló, run_followup_stream llama a la API
+
             try:
-                resp2 = client.responses.create(
-                    model=st.session_state["reflexia_model"],
-                    instructions=REFLEXIA_FOLLOWUP,
-                    input=follow_input,
-                )
                 st.subheader("Siguiente paso sugerido")
-                st.code(resp2.output_text, language="text")
+                st.write_stream(run_followup_stream(st.session_state["reflexia_model"], follow_input))
             except Exception as e:
                 st.error(f"Error al generar el siguiente paso: {e}")
 
-st.divider()
-st.caption("© jbc.elearning - 2026")
+footer()
 
 
 